@@ -17,6 +17,14 @@ async def main():
 
     try:
         persistent_objects = set()
+        if "history-dir" in config:
+            from sensor2mqtt.History import History
+            try:
+                History(sensor_controller, config["history-dir"],
+                        budget=config.get("history-budget", 64))
+            except ValueError as e:
+                logger.error("History disabled: %s", e)
+
         if "ds18b20-pins" in config:
             from sensor2mqtt.DS18B20s import DS18B20s
             persistent_objects.add(
@@ -34,6 +42,14 @@ async def main():
                 TSL2561(sensor_controller, **kwargs)
                 )
 
+        if "iio" in config:
+            from sensor2mqtt.IIO import IIO
+            for iio_config in config["iio"]:
+                kwargs = {k.replace("-", "_"): v
+                          for k, v in iio_config.items()}
+                persistent_objects.add(
+                    IIO(sensor_controller, **kwargs))
+
         if "pir-pins" in config:
             from sensor2mqtt.PIR import PIR
             for pin in config["pir-pins"]:
@@ -75,8 +91,13 @@ if __name__ == '__main__':
                #"gmqtt",
                "baker",
                "sensor2mqtt.SensorController",
+               "sensor2mqtt.Brokers",
+               "sensor2mqtt.Query",
+               "sensor2mqtt.Sampling",
+               "sensor2mqtt.History",
                "sensor2mqtt.TSL2561",
                "sensor2mqtt.DS18B20s",
+               "sensor2mqtt.IIO",
                "sensor2mqtt.PIR",
                "sensor2mqtt.Relays",
                "sensor2mqtt.Switches"]
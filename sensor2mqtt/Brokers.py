@@ -0,0 +1,174 @@
+import asyncio
+import collections
+import logging
+import os
+import socket
+
+from gmqtt import Client as MQTTClient
+from gmqtt.mqtt.constants import MQTTv311
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Broker:
+    """A single MQTT broker connection.
+
+    Each broker has its own gmqtt client, its own queue of messages
+    waiting to be sent and its own health state. While the broker is
+    up messages are handed straight to gmqtt, which never blocks.
+    While it is down they are queued and a per-broker sender task
+    sends them when it comes back, so a missing broker never blocks
+    the caller.
+
+    max_pending limits how many messages are queued while the broker
+    is down. When it is full the oldest message is dropped. Messages
+    already handed to gmqtt but not yet acknowledged are not counted.
+    """
+    # Override to connect using a stand-in client
+    client_class = MQTTClient
+
+    def __init__(self, controller, host, port=1883, username=None,
+                 password=None, max_pending=100, name=None):
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.name = name or f"{host}:{port}"
+        self.pending = collections.deque(maxlen=max_pending)
+        self.dropped = 0
+        self.healthy = False
+        self.failures = 0
+        self.mqtt = None
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def __repr__(self):
+        return f"<Broker {self.name} {'up' if self.healthy else 'down'}>"
+
+    async def start(self):
+        client_id = f"{socket.gethostname()}.{os.getpid()}"
+        self.mqtt = self.client_class(client_id)
+        if self.username is not None:
+            self.mqtt.set_auth_credentials(username=self.username,
+                                           password=self.password)
+
+        self.mqtt.on_connect = self.on_connect
+        self.mqtt.on_message = self.on_message
+        self.mqtt.on_disconnect = self.on_disconnect
+
+        self._tasks = [asyncio.create_task(self.connect()),
+                       asyncio.create_task(self.sender())]
+
+    async def connect(self):
+        # Connect to the broker, retrying forever. Once connected
+        # gmqtt handles any reconnection itself.
+        delay = 1
+        while not self.mqtt.is_connected:
+            try:
+                await self.mqtt.connect(self.host, port=self.port,
+                                        version=MQTTv311)
+            except Exception as e:
+                self.failures += 1
+                LOGGER.warning(f"Error trying to connect to {self.name}: "
+                               f"{e}. Retrying in {delay}s.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def sender(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                self.flush()
+        except asyncio.CancelledError:
+            LOGGER.debug(f"{self.name} sender exiting cleanly")
+
+    def send(self, topic, payload, retain):
+        """Returns True if gmqtt took the message"""
+        try:
+            self.mqtt.publish(topic, payload, qos=2, retain=retain)
+        except Exception as e:
+            LOGGER.warning(f"Error publishing {topic} to "
+                           f"{self.name}: {e}")
+            return False
+        return True
+
+    def flush(self):
+        while self.pending and self.healthy:
+            if not self.send(*self.pending[0]):
+                break
+            self.pending.popleft()
+
+    def publish(self, topic, payload, retain=True):
+        """Send :param payload: to :param topic: or queue it if the
+        broker is down. This never blocks."""
+        # Keep order: only skip the queue if it is empty
+        if (self.healthy and not self.pending and
+                self.send(topic, payload, retain)):
+            return
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+            LOGGER.warning(f"{self.name} queue full, dropping oldest "
+                           f"message ({self.dropped} dropped)")
+        self.pending.append((topic, payload, retain))
+        self._wakeup.set()
+
+    def adopt(self, other):
+        """Take over the messages queued on :param other: ahead of our
+        own"""
+        if not other.pending:
+            return
+        messages = list(other.pending) + list(self.pending)
+        other.pending.clear()
+        excess = len(messages) - self.pending.maxlen
+        if excess > 0:
+            self.dropped += excess
+            LOGGER.warning(f"{self.name} queue full, dropping {excess} "
+                           f"messages taken from {other.name}")
+            messages = messages[excess:]
+        LOGGER.debug(f"{self.name} taking {len(messages)} messages "
+                     f"from {other.name}")
+        self.pending.clear()
+        self.pending.extend(messages)
+        self._wakeup.set()
+
+    def subscribe(self, topic):
+        if self.healthy:
+            LOGGER.debug(f"Subscribing to {topic} on {self.name}")
+            self.mqtt.subscribe(topic)
+
+    def on_connect(self, _client, _flags, _rc, _properties):
+        self.healthy = True
+        for s in self.controller.subscriptions:
+            LOGGER.debug(f"Re-subscribing to {s} on {self.name}")
+            self.mqtt.subscribe(s)
+        LOGGER.debug(f"Connected and subscribed to {self.name}")
+        self._wakeup.set()
+        self.controller.broker_health_changed(self)
+
+    async def on_message(self, client, topic, payload, qos, properties):
+        if self not in self.controller.active_brokers():
+            LOGGER.debug(f"Ignoring {topic} from standby {self.name}")
+            return
+        await self.controller.on_message(client, topic, payload,
+                                         qos, properties)
+
+    def on_disconnect(self, _client, _packet, _exc=None):
+        self.healthy = False
+        self.failures += 1
+        LOGGER.debug(f"Disconnected from {self.name}")
+        self.controller.broker_health_changed(self)
+
+    async def stop(self):
+        # Send any last messages before disconnecting
+        self.flush()
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.mqtt.is_connected:
+            await self.mqtt.disconnect()
+        if self.pending:
+            LOGGER.warning(f"{len(self.pending)} messages not sent "
+                           f"to {self.name}")
@@ -10,12 +10,15 @@ class DS18B20s:
     def __init__(self, controller, pins, period=30):
         self.controller = controller
         self.period = period
+        self.prefix = "sensor/w1/temperature/"
         self.pullups = set()
         for p in pins:
             logger.debug(f"Setting pullup for pin {p}")
             self.pullups.add(InputDevice(pin=p, pull_up=True))
-        self._task = asyncio.create_task(self.run())
-        controller.add_cleanup_callback(self.stop)
+        controller.cache.add_source(self.prefix, self.read)
+        if controller.sampler.periodic:
+            self._task = asyncio.create_task(self.run())
+            controller.add_cleanup_callback(self.stop)
 
     async def run(self):
         # Maybe persist this so we don't have 'New' probes each run
@@ -26,7 +29,10 @@ class DS18B20s:
                 # with all of them and removing probes from this set
                 # when we see them
                 notseen_probes = set(probes.keys())
-                async for (serial, temp) in self.get_temp():
+                # Share the read with any queries waiting on the bus
+                readings = await self.controller.cache.read(self.prefix)
+                for (topic, temp) in readings.items():
+                    serial = topic[len(self.prefix):]
 
                     # We've seen the probe - even if it's failed to
                     # read and discard doesn't care if it's new
@@ -47,11 +53,9 @@ class DS18B20s:
                             "New", retain=False)
                         probes[serial] = None  # No old temp
 
-                    # Publish anything we find as a float
+                    # Publish anything we find
                     if probes[serial] != temp:
-                        self.controller.publish(
-                            f'sensor/w1/temperature/{serial}',
-                            float(temp) / float(1000.0))
+                        self.controller.publish(topic, temp)
                     else:
                         logger.debug(f"Probe {serial} unchanged at {temp}")
 
@@ -75,6 +79,13 @@ class DS18B20s:
         self._task.cancel()
         await self._task
 
+    async def read(self):
+        """Returns {topic: temperature} for every probe with None for
+        probes that failed to read"""
+        return {f"{self.prefix}{serial}":
+                float(temp) / float(1000.0) if temp is not None else None
+                async for (serial, temp) in self.get_temp()}
+
     async def get_temp(self):
         w1_path = "/sys/bus/w1/devices"
         with os.scandir(w1_path) as devices:
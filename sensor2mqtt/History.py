@@ -0,0 +1,322 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct("<dHHf")  # time, series, lap, value
+BLOCK = struct.Struct("<df")  # time, value as sent in query replies
+BLOCK_RECORDS = 1024
+
+
+class Ring:
+    """A fixed size memory-mapped file of records written in order,
+    wrapping round at the end so the file never grows and writes are
+    always sequential.
+
+    Each record carries the lap it was written in (never 0) so the
+    write position can be found when the file is reopened without
+    keeping a header that is rewritten on every append.
+    """
+    def __init__(self, path, size):
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(size)
+        elif os.path.getsize(path) != size:
+            logger.info(f"Keeping existing size of {path}; delete it "
+                        f"to apply a new history-budget")
+        self.path = path
+        self.file = open(path, "r+b")
+        self.capacity = os.path.getsize(path) // RECORD.size
+        self.map = mmap.mmap(self.file.fileno(),
+                             self.capacity * RECORD.size)
+        self.head, self.lap = self.find_head()
+
+    @staticmethod
+    def next_lap(lap):
+        return lap % 0xFFFF + 1
+
+    def lap_at(self, i):
+        return RECORD.unpack_from(self.map, i * RECORD.size)[2]
+
+    def find_head(self):
+        # Records before the head are in the current lap; binary
+        # search for the first one that isn't
+        lap = self.lap_at(0)
+        if lap == 0:
+            return 0, 1
+        lo, hi = 1, self.capacity
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.lap_at(mid) == lap:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.capacity:
+            return 0, self.next_lap(lap)
+        return lo, lap
+
+    def append(self, t, series, value):
+        RECORD.pack_into(self.map, self.head * RECORD.size,
+                         t, series, self.lap, value)
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+            self.lap = self.next_lap(self.lap)
+
+    @property
+    def wrapped(self):
+        # Once the ring has wrapped every slot holds a record
+        return self.lap_at(self.head) != 0
+
+    def position(self):
+        """Returns (head, wrapped) for :func:`records` to use so that
+        appends made while it runs in another thread don't move it"""
+        return self.head, self.wrapped
+
+    def time_at(self, k, head, wrapped):
+        # k counts from the oldest record
+        i = (head + k) % self.capacity if wrapped else k
+        return RECORD.unpack_from(self.map, i * RECORD.size)[0]
+
+    def bisect(self, t, head, wrapped, right=False):
+        """Returns how many of the oldest records are before :param t:
+        (or at it too if :param right:)"""
+        lo, hi = 0, self.capacity if wrapped else head
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_t = self.time_at(mid, head, wrapped)
+            if mid_t < t or (right and mid_t == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _chunks(self, start, end):
+        for i in range(start, end, BLOCK_RECORDS):
+            j = min(i + BLOCK_RECORDS, end)
+            yield from RECORD.iter_unpack(
+                self.map[i * RECORD.size:j * RECORD.size])
+
+    def records(self, start=None, end=None, position=None):
+        """Yields (time, series, lap, value) oldest first. Records are
+        written in time order so :param start: and :param end: are
+        found by binary search and only that slice is decoded.
+        :param position: is from :func:`position`, defaulting to now.
+        """
+        head, wrapped = position or self.position()
+        lo = 0 if start is None else self.bisect(start, head, wrapped)
+        hi = (self.bisect(end, head, wrapped, right=True)
+              if end is not None else
+              self.capacity if wrapped else head)
+        if not wrapped:
+            yield from self._chunks(lo, hi)
+            return
+        lo += head
+        hi += head
+        yield from self._chunks(lo, min(hi, self.capacity))
+        if hi > self.capacity:
+            yield from self._chunks(max(lo, self.capacity) - self.capacity,
+                                    hi - self.capacity)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class Tier:
+    def __init__(self, name, width, retention, ring):
+        self.name = name
+        self.width = width  # seconds averaged per record; 0 for raw
+        self.retention = retention
+        self.ring = ring
+        self.buckets = {}  # series: [bucket start, sum, count]
+        self.current = None  # start of the latest bucket
+
+    def add(self, t, series, value):
+        if not self.width:
+            self.ring.append(t, series, value)
+            return
+        start = t - t % self.width
+        if self.current is not None and start < self.current:
+            # The clock went back; don't write out of time order
+            start = self.current
+        if start != self.current:
+            # Write out every bucket that has ended, not just this
+            # series', so the ring stays in time order for bisect
+            self.current = start
+            for s in sorted(self.buckets,
+                            key=lambda s: self.buckets[s][0]):
+                self.flush(s)
+        bucket = self.buckets.get(series, None)
+        if bucket is None:
+            self.buckets[series] = [start, value, 1]
+        else:
+            bucket[1] += value
+            bucket[2] += 1
+
+    def flush(self, series):
+        start, total, count = self.buckets.pop(series)
+        self.ring.append(start, series, total / count)
+
+
+class History:
+    """Keeps every numeric value published on a sensor/ topic in
+    memory-mapped ring files under history-dir.
+
+    There are three tiers: raw values kept for an hour, 1 minute
+    means kept for 7 days and 1 hour means kept for a year. The files
+    are allocated up front from history-budget (MB) so disk use is
+    fixed; if a tier fills before its retention time its oldest
+    records are overwritten.
+
+    Ranges are requested by publishing json to control/history/<host>:
+      {"id": "q1", "topic": "sensor/...", "start": <unix time>,
+       "end": <unix time>, "tier": "raw" | "minute" | "hour"}
+    "end" defaults to now and "tier" to the finest tier still holding
+    "start". "id" must not contain /, + or #. The reply is published as zlib compressed blocks of
+    little-endian (double time, float value) pairs to
+    info/history/<host>/<id>/<n> followed by a json summary on
+    info/history/<host>/<id>.
+    """
+    TIERS = (
+        # name, seconds per record, retention, share of budget
+        ("raw", 0, 3600, 0.5),
+        ("minute", 60, 7 * 86400, 0.3),
+        ("hour", 3600, 365 * 86400, 0.2),
+    )
+
+    def __init__(self, controller, path, budget=64):
+        self.controller = controller
+        self.path = path
+        sizes = {}
+        for name, _width, _retention, share in self.TIERS:
+            size = int(budget * 1024 * 1024 * share)
+            sizes[name] = size - size % RECORD.size
+            if sizes[name] <= 0:
+                raise ValueError(f"history-budget of {budget}MB is too "
+                                 f"small for the {name} tier")
+        os.makedirs(path, exist_ok=True)
+        self.tiers = {}
+        for name, width, retention, _share in self.TIERS:
+            ring = Ring(os.path.join(path, f"{name}.dat"), sizes[name])
+            self.tiers[name] = Tier(name, width, retention, ring)
+        self.series = self.load_series()
+        self.closed = False
+        # Scans run one at a time in their own thread and close()
+        # waits for them before unmapping the rings
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.scans = set()
+
+        self.q_topic = f"control/history/{controller.host}"
+        self.r_topic = f"info/history/{controller.host}"
+        controller.history = self
+        controller.subscribe(self.q_topic)
+        controller.add_handler(self.handle_message)
+        controller.add_cleanup_callback(self.close)
+
+    def load_series(self):
+        # One topic per line; the line number is the series id
+        series = {}
+        try:
+            with open(os.path.join(self.path, "series"), "r") as f:
+                for n, line in enumerate(f):
+                    series[line.rstrip("\n")] = n
+        except FileNotFoundError:
+            pass
+        return series
+
+    def series_id(self, topic):
+        sid = self.series.get(topic, None)
+        if sid is None:
+            sid = len(self.series)
+            with open(os.path.join(self.path, "series"), "a") as f:
+                f.write(f"{topic}\n")
+            self.series[topic] = sid
+        return sid
+
+    def append(self, topic, payload):
+        if self.closed or not isinstance(payload, (bool, int, float)):
+            return
+        t = time.time()
+        sid = self.series_id(topic)
+        for tier in self.tiers.values():
+            tier.add(t, sid, float(payload))
+
+    def choose_tier(self, start):
+        age = time.time() - start
+        for tier in self.tiers.values():
+            if age <= tier.retention:
+                return tier
+        return tier
+
+    def scan(self, tier, sid, start, end, position):
+        start = max(start, time.time() - tier.retention)
+        # Check the times too as the oldest records may be overwritten
+        # by appends while we read
+        return [(t, value) for (t, series, _lap, value)
+                in tier.ring.records(start, end, position)
+                if series == sid and start <= t <= end]
+
+    async def handle_message(self, topic, payload):
+        # control/history/<host>
+        if topic != self.q_topic:
+            return False
+        if self.closed:
+            return True
+        try:
+            query = json.loads(payload.decode("utf-8"))
+            if not isinstance(query, dict):
+                raise ValueError("query must be a json object")
+            qid = str(query["id"])
+            if not qid or any(c in qid for c in "/+#"):
+                raise ValueError(f"bad id '{qid}'")
+            sid = self.series[query["topic"]]
+            start = float(query.get("start", 0))
+            end = float(query.get("end", time.time()))
+            if "tier" in query:
+                tier = self.tiers[query["tier"]]
+            else:
+                tier = self.choose_tier(start)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Bad history query {payload}: {e}")
+            return True
+
+        scan = self._executor.submit(self.scan, tier, sid, start, end,
+                                     tier.ring.position())
+        self.scans.add(scan)
+        scan.add_done_callback(self.scans.discard)
+        records = await asyncio.wrap_future(scan)
+        blocks = 0
+        for i in range(0, len(records), BLOCK_RECORDS):
+            block = b"".join(BLOCK.pack(*r)
+                             for r in records[i:i + BLOCK_RECORDS])
+            self.controller.publish(f"{self.r_topic}/{qid}/{blocks}",
+                                    zlib.compress(block), retain=False)
+            blocks += 1
+        self.controller.publish(f"{self.r_topic}/{qid}", json.dumps({
+            "topic": query["topic"],
+            "tier": tier.name,
+            "records": len(records),
+            "blocks": blocks,
+        }), retain=False)
+        return True
+
+    async def close(self):
+        self.closed = True
+        await asyncio.gather(*[asyncio.wrap_future(s)
+                               for s in list(self.scans)],
+                             return_exceptions=True)
+        self._executor.shutdown()
+        # Write out the partial means so a restart doesn't lose them
+        for tier in self.tiers.values():
+            for series in list(tier.buckets):
+                tier.flush(series)
+            tier.ring.close()
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import os
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class IIOChannel:
+    """One scan element of an IIO device and how to decode it.
+
+    The type is described by the kernel as
+    [be|le]:[s|u]bits/storagebits[Xrepeat]>>shift
+    """
+    TYPE_RE = re.compile(r"(be|le):([su])(\d+)/(\d+)(?:X(\d+))?>>(\d+)")
+
+    def __init__(self, name, index, type_desc, scale=1.0, offset=0.0):
+        m = self.TYPE_RE.fullmatch(type_desc.strip())
+        if m is None:
+            raise ValueError(f"Can't parse IIO type '{type_desc}' "
+                             f"for {name}")
+        endian, sign, bits, storage, repeat, shift = m.groups()
+        if repeat is not None and int(repeat) != 1:
+            raise ValueError(f"Repeated IIO channel {name} not supported")
+        self.name = name
+        self.index = index
+        self.big_endian = endian == "be"
+        self.signed = sign == "s"
+        self.bits = int(bits)
+        self.storage = int(storage) // 8
+        self.shift = int(shift)
+        self.scale = scale
+        self.offset = offset
+
+    @property
+    def dtype(self):
+        return (f"{'>' if self.big_endian else '<'}"
+                f"{'i' if self.signed else 'u'}{self.storage}")
+
+    def decode(self, scans):
+        """Converts a column of raw scans to scaled values"""
+        v = scans[self.name].astype(np.int64)
+        if self.shift:
+            v >>= self.shift
+        if self.bits < 64:
+            v &= (1 << self.bits) - 1
+            if self.signed:
+                sign = 1 << (self.bits - 1)
+                v = (v ^ sign) - sign
+        return (v + self.offset) * self.scale
+
+
+class IIO:
+    """Streams a Linux IIO device using triggered buffered capture.
+
+    Blocks of decimate samples are read in one go from
+    /dev/iio:deviceN and decoded with numpy. Each block is then
+    published per channel as its mean or rms to
+    sensor/iio/<host>/<device>/<channel>, or as packed little-endian
+    float32 values to block/iio/<host>/<device>/<channel>.
+
+    If buffer_file is given it is replayed instead of the device and
+    nothing is written to sysfs; point sysfs at a copy of the device's
+    sysfs directory so the scan layout can be read. The layout is then
+    the channels enabled in that copy and channels only selects which
+    are published.
+    """
+    REDUCE = ("mean", "rms", "block")
+
+    def __init__(self, controller, device="iio:device0", channels=None,
+                 trigger=None, rate=None, decimate=100, reduce="mean",
+                 buffer_file=None, sysfs="/sys/bus/iio/devices",
+                 dev="/dev"):
+        if reduce not in self.REDUCE:
+            raise ValueError(f"Unknown IIO reduce {reduce}")
+        self.controller = controller
+        self.device = device
+        self.path = os.path.join(sysfs, device)
+        self.decimate = decimate
+        self.reduce = reduce
+        self.rate = rate
+        self.topic = f"iio/{controller.host}/{device}"
+        self.loop = asyncio.get_running_loop()
+        self.playback = buffer_file is not None
+
+        self.channels = self.get_channels(channels)
+        self.published = [c for c in self.channels
+                          if c.name != "timestamp" and
+                          (not channels or c.name in channels)]
+        self.scan_dtype = np.dtype({
+            "names": [c.name for c in self.channels],
+            "formats": [c.dtype for c in self.channels],
+            "offsets": self.offsets(),
+            "itemsize": self.scan_size(),
+        })
+        logger.info(f"IIO {device}: {[c.name for c in self.channels]} "
+                    f"{self.scan_dtype.itemsize} bytes per scan")
+
+        if self.playback:
+            self.fd = os.open(buffer_file, os.O_RDONLY)
+        else:
+            self.start_buffer(trigger)
+            self.fd = os.open(os.path.join(dev, device),
+                              os.O_RDONLY | os.O_NONBLOCK)
+        self._partial = b""
+
+        self._task = asyncio.create_task(self.run())
+        controller.add_cleanup_callback(self.stop)
+
+    def read_attr(self, name, default=None):
+        try:
+            with open(os.path.join(self.path, name), "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return default
+
+    def write_attr(self, name, value):
+        logger.debug(f"IIO {self.device}: {name} = {value}")
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(f"{value}")
+
+    def channel_attr(self, name, attr, default):
+        # Try the channel's own attribute then the shared one for its
+        # type, eg in_voltage0_scale, in_voltage_scale
+        # or in_accel_x_scale, in_accel_scale
+        for n in (name, name.rstrip("0123456789"), name.rsplit("_", 1)[0]):
+            v = self.read_attr(f"in_{n}_{attr}")
+            if v is not None:
+                return float(v)
+        return default
+
+    def get_channels(self, wanted):
+        scan_dir = os.path.join(self.path, "scan_elements")
+        names = sorted(f[3:-3] for f in os.listdir(scan_dir)
+                       if f.startswith("in_") and f.endswith("_en"))
+        if self.playback:
+            # The recording's layout is whatever was enabled
+            names = [n for n in names
+                     if self.read_attr(f"scan_elements/in_{n}_en") == "1"]
+        if wanted:
+            missing = set(wanted) - set(names)
+            if missing:
+                raise ValueError(f"IIO {self.device} has no channels "
+                                 f"{sorted(missing)}")
+            if not self.playback:
+                names = wanted
+        channels = []
+        for name in names:
+            channels.append(IIOChannel(
+                name,
+                int(self.read_attr(f"scan_elements/in_{name}_index")),
+                self.read_attr(f"scan_elements/in_{name}_type"),
+                scale=self.channel_attr(name, "scale", 1.0),
+                offset=self.channel_attr(name, "offset", 0.0)))
+        return sorted(channels, key=lambda c: c.index)
+
+    def offsets(self):
+        # Each element is aligned to its own storage size
+        offsets = []
+        pos = 0
+        for c in self.channels:
+            pos += -pos % c.storage
+            offsets.append(pos)
+            pos += c.storage
+        return offsets
+
+    def scan_size(self):
+        last = self.channels[-1]
+        size = self.offsets()[-1] + last.storage
+        align = max(c.storage for c in self.channels)
+        return size + -size % align
+
+    def start_buffer(self, trigger):
+        # The buffer must be off to change the scan
+        self.write_attr("buffer/enable", 0)
+        wanted = {c.name for c in self.channels}
+        scan_dir = os.path.join(self.path, "scan_elements")
+        for f in os.listdir(scan_dir):
+            if f.startswith("in_") and f.endswith("_en"):
+                self.write_attr(f"scan_elements/{f}",
+                                int(f[3:-3] in wanted))
+        if trigger is not None:
+            self.write_attr("trigger/current_trigger", trigger)
+        if self.rate is not None:
+            self.write_attr("sampling_frequency", self.rate)
+        self.write_attr("buffer/length", self.decimate * 4)
+        if self.read_attr("buffer/watermark") is not None:
+            # Only wake us when there's a whole block to read
+            self.write_attr("buffer/watermark", self.decimate)
+        self.write_attr("buffer/enable", 1)
+
+    async def read_block(self):
+        """Returns the raw bytes of up to decimate whole scans"""
+        size = self.scan_dtype.itemsize * self.decimate
+        if self.playback:
+            if self.rate:
+                await asyncio.sleep(self.decimate / self.rate)
+            else:
+                await asyncio.sleep(0)
+            data = os.read(self.fd, size - len(self._partial))
+            if not data:
+                raise EOFError()
+        else:
+            ready = self.loop.create_future()
+            self.loop.add_reader(self.fd, ready.set_result, None)
+            try:
+                await ready
+            finally:
+                self.loop.remove_reader(self.fd)
+            try:
+                data = os.read(self.fd, size - len(self._partial))
+            except BlockingIOError:
+                # Woken with nothing to read; wait again
+                return b""
+
+        data = self._partial + data
+        whole = len(data) - len(data) % self.scan_dtype.itemsize
+        self._partial = data[whole:]
+        return data[:whole]
+
+    def publish(self, scans):
+        for c in self.published:
+            values = c.decode(scans)
+            if self.reduce == "block":
+                self.controller.publish(
+                    f"block/{self.topic}/{c.name}",
+                    values.astype("<f4").tobytes(), retain=False)
+            elif self.reduce == "rms":
+                self.controller.publish(
+                    f"sensor/{self.topic}/{c.name}",
+                    float(np.sqrt(np.mean(np.square(values)))))
+            else:
+                self.controller.publish(
+                    f"sensor/{self.topic}/{c.name}",
+                    float(np.mean(values)))
+
+    async def run(self):
+        try:
+            while True:
+                data = await self.read_block()
+                if not data:
+                    continue
+                scans = np.frombuffer(data, dtype=self.scan_dtype)
+                self.publish(scans)
+        except EOFError:
+            logger.info(f"IIO {self.device} end of buffer file")
+        except OSError as e:
+            logger.warning(f"IIO {self.device} stopped: '{e}' thrown "
+                           f"reading the buffer")
+        except asyncio.CancelledError:  # This will be raised politely in await
+            logger.debug(f"IIO {self.device} exiting cleanly")
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            # Cancelled before run() started
+            pass
+        try:
+            if not self.playback:
+                self.write_attr("buffer/enable", 0)
+        except OSError as e:
+            logger.warning(f"IIO {self.device}: '{e}' thrown "
+                           f"disabling the buffer")
+        os.close(self.fd)
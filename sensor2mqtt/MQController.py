@@ -1,12 +1,12 @@
 import asyncio
 import inspect
 import logging
-import os
 import signal
 import socket
 
-from gmqtt import Client as MQTTClient
-from gmqtt.mqtt.constants import MQTTv311
+from .Brokers import Broker
+from .Query import ReadingCache
+from .Sampling import Sampler
 
 
 LOGGER = logging.getLogger(__name__)
@@ -18,7 +18,13 @@ class MQController:
 
     Essentially it abstracts all the setup, msg handling and cleanup
     into one place.
+
+    It may talk to several brokers. In "failover" mode messages go to
+    the first healthy broker in the configured order; in "fanout" mode
+    they go to every broker.
     """
+    MODES = ("failover", "fanout")
+
     def __init__(self, config):
         self._loop = asyncio.get_event_loop()
         self.subscriptions = []
@@ -27,31 +33,51 @@ class MQController:
         self.host = socket.gethostname()
         self.cleanup_callbacks = set()
         self.stop_event = asyncio.Event()
-        self.mqtt = None
+        self.mode = config.get("mqtt-mode", "failover")
+        if self.mode not in self.MODES:
+            raise ValueError(f"Unknown mqtt-mode {self.mode}")
+        self.brokers = []
+        self._active = None
+        self._connected = asyncio.Event()
+        self.cache = ReadingCache(self, ttl=config.get("query-ttl", 60))
+        self.sampler = Sampler(
+            self, mode=config.get("sample-mode", "periodic"),
+            topic=config.get("sample-topic", "control/sample"))
+        self.history = None  # Set up by History if configured
+
+    def make_brokers(self):
+        """Returns a list of :class:`Broker` from the config. Either
+        mqtt_host or a list of mqtt-brokers tables may be given. Each
+        broker defaults to the top level username and password.
+        """
+        broker_configs = self.config.get("mqtt-brokers", None)
+        if not broker_configs:
+            broker_configs = [{"host": self.config["mqtt_host"]}]
+        brokers = []
+        for bc in broker_configs:
+            kwargs = {
+                "username": self.config.get("username", None),
+                "password": self.config.get("password", None),
+            }
+            for k in ("host", "port", "username", "password",
+                      "max-pending", "name"):
+                v = bc.get(k, None)
+                if v is not None:
+                    kwargs[k.replace("-", "_")] = v
+            brokers.append(Broker(self, **kwargs))
+        return brokers
 
     async def connect(self):
-        self.mqtt = MQTTClient(f"{socket.gethostname()}.{os.getpid()}")
-        self.mqtt.set_auth_credentials(username=self.config["username"],
-                                       password=self.config["password"])
-
-        self.mqtt.on_connect = self.on_connect
-        self.mqtt.on_message = self.on_message
-        self.mqtt.on_disconnect = self.on_disconnect
-
         self._loop.add_signal_handler(signal.SIGINT, self.ask_exit)
         self._loop.add_signal_handler(signal.SIGTERM, self.ask_exit)
         self._loop.set_exception_handler(self.handle_exception)
 
-        mqtt_host = self.config["mqtt_host"]
-        mqtt_version = MQTTv311
+        self.brokers = self.make_brokers()
+        for b in self.brokers:
+            await b.start()
 
-        # Connect to the broker
-        while not self.mqtt.is_connected:
-            try:
-                await self.mqtt.connect(mqtt_host, version=mqtt_version)
-            except Exception as e:
-                LOGGER.warn(f"Error trying to connect: {e}. Retrying.")
-                await asyncio.sleep(1)
+        # Wait until at least one broker is connected
+        await self._connected.wait()
 
     async def setup(self):
         # Override to do any setup
@@ -82,7 +108,8 @@ class MQController:
             if inspect.isawaitable(res):
                 await res
 
-        await self.mqtt.disconnect()  # Disconnect after any last messages sent
+        # Disconnect after any last messages sent
+        await asyncio.gather(*[b.stop() for b in self.brokers])
         LOGGER.debug(f"client disconnected")
 
     def add_handler(self, handler):
@@ -119,23 +146,49 @@ class MQController:
         """Subscribes to an MQTT topic (passed directly to MQTT)"""
         if topic not in self.subscriptions:
             self.subscriptions.append(topic)
-            if self.mqtt:
-                LOGGER.debug(f"Subscribing to {topic}")
-                self.mqtt.subscribe(topic)
-
-    def on_connect(self, _client, _flags, _rc, _properties):
-        for s in self.subscriptions:
-            LOGGER.debug(f"Re-subscribing to {s}")
-            self.mqtt.subscribe(s)
-        LOGGER.debug('Connected and subscribed')
-
-    def on_disconnect(self, _client, _packet, _exc=None):
-        LOGGER.debug('Disconnected')
+            for b in self.brokers:
+                b.subscribe(topic)
+
+    def active_brokers(self):
+        """The brokers that messages are currently sent to and accepted
+        from"""
+        if self.mode == "fanout":
+            return self.brokers
+        for b in self.brokers:
+            if b.healthy:
+                return [b]
+        # Nothing is up; queue for the primary until something is
+        return self.brokers[:1]
+
+    def broker_health_changed(self, broker):
+        if any(b.healthy for b in self.brokers):
+            self._connected.set()
+        if self.mode != "failover":
+            return
+        active = self.active_brokers()[0]
+        if not active.healthy:
+            return
+        if active is not self._active:
+            if self._active is not None:
+                LOGGER.warning(f"Failing over from {self._active.name} "
+                               f"to {active.name}")
+            self._active = active
+        # Anything still queued on a broker that is down goes to the
+        # active one instead
+        for b in self.brokers:
+            if not b.healthy:
+                active.adopt(b)
 
     def publish(self, topic, payload, retain=True):
-        """Publish :param payload: to :param topic:"""
+        """Publish :param payload: to :param topic: This never blocks;
+        each broker sends from its own queue."""
         LOGGER.debug(f"Publishing {topic} = {payload}")
-        self.mqtt.publish(topic, payload, qos=2, retain=retain)
+        if topic.startswith("sensor/"):
+            self.cache.update(topic, payload)
+            if self.history is not None:
+                self.history.append(topic, payload)
+        for b in self.active_brokers():
+            b.publish(topic, payload, retain=retain)
 
     def ask_exit(self):
         """Handle outstanding messages and cleanly disconnect"""
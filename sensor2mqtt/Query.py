@@ -0,0 +1,150 @@
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Source:
+    def __init__(self, prefix, read):
+        self.prefix = prefix
+        self.read = read
+        self.last_read = None
+        self.started = None
+        self.task = None
+
+    def overlaps(self, prefix):
+        return (self.prefix.startswith(prefix) or
+                prefix.startswith(self.prefix))
+
+
+class ReadingCache:
+    """Holds the latest value published for every sensor topic and
+    answers queries on control/query/<host> from it.
+
+    Sensors that poll hardware register a source: an async callable
+    returning {topic: value}. All hardware reads go through
+    :func:`read` so a periodic loop and any number of queries share a
+    single read in progress. A query only triggers a read if the
+    source has not been read within ttl seconds.
+
+    The query payload is an optional topic prefix and the answer is
+    published as json to info/query/<host>. To tell answers apart the
+    payload may instead be json:
+      {"id": "dash1", "prefix": "sensor/w1/"}
+    and the answer, carrying the id, goes to info/query/<host>/<id>.
+    """
+    def __init__(self, controller, ttl=60):
+        self.controller = controller
+        self.ttl = ttl
+        self.readings = {}  # topic: (value, monotonic time)
+        self.sources = {}
+        self.q_topic = f"control/query/{controller.host}"
+        self.r_topic = f"info/query/{controller.host}"
+        controller.subscribe(self.q_topic)
+        controller.add_handler(self.handle_message)
+        controller.add_cleanup_callback(self.stop)
+
+    def add_source(self, prefix, read):
+        self.sources[prefix] = Source(prefix, read)
+
+    def update(self, topic, value):
+        self.readings[topic] = (value, time.monotonic())
+
+    async def read(self, prefix, since=None):
+        """Read the source registered for :param prefix: from the
+        hardware, joining any read already in progress. If :param
+        since: (a monotonic time) is given a read that started before
+        then is left to finish and a fresh one is made.
+        """
+        source = self.sources[prefix]
+        if (source.task is not None and since is not None and
+                source.started < since):
+            await asyncio.wait([source.task])
+        if source.task is None:
+            source.started = time.monotonic()
+            source.task = asyncio.create_task(self._read(source))
+        return await asyncio.shield(source.task)
+
+    async def _read(self, source):
+        try:
+            readings = await source.read()
+            for topic, value in readings.items():
+                if value is not None:
+                    self.update(topic, value)
+            source.last_read = time.monotonic()
+            return readings
+        finally:
+            source.task = None
+
+    def is_stale(self, source):
+        return (source.last_read is None or
+                time.monotonic() - source.last_read > self.ttl)
+
+    async def get(self, prefix=""):
+        """Returns {topic: (value, age)} for all topics starting with
+        :param prefix: refreshing stale sources first"""
+        stale = [s.prefix for s in self.sources.values()
+                 if s.overlaps(prefix) and self.is_stale(s)]
+        results = await asyncio.gather(*[self.read(p) for p in stale],
+                                       return_exceptions=True)
+        for p, res in zip(stale, results):
+            if isinstance(res, Exception):
+                logger.warning(f"Exception '{res}' refreshing {p}")
+
+        now = time.monotonic()
+        return {topic: (value, now - t)
+                for topic, (value, t) in self.readings.items()
+                if topic.startswith(prefix)}
+
+    async def stop(self):
+        # Reads are shielded from their callers so cancel any still
+        # running here
+        tasks = [s.task for s in self.sources.values()
+                 if s.task is not None]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle_message(self, topic, payload):
+        # control/query/<host>
+        if topic != self.q_topic:
+            return False
+        try:
+            prefix = payload.decode("utf-8").strip()
+        except UnicodeDecodeError as e:
+            logger.warning(f"Bad query {payload}: {e}")
+            return True
+
+        qid = None
+        if prefix.startswith("{"):
+            try:
+                query = json.loads(prefix)
+            except ValueError as e:
+                logger.warning(f"Bad query {prefix}: {e}")
+                return True
+            qid = query.get("id", None)
+            prefix = query.get("prefix", "")
+            if qid is not None:
+                qid = str(qid)
+            if (not isinstance(prefix, str) or
+                    (qid is not None and
+                     (not qid or any(c in qid for c in "/+#")))):
+                logger.warning(f"Bad query {query}")
+                return True
+
+        readings = await self.get(prefix)
+        logger.debug(f"Answering query for '{prefix}' with "
+                     f"{len(readings)} readings")
+        answer = {
+            "prefix": prefix,
+            "readings": {topic: {"value": value, "age": round(age, 3)}
+                         for topic, (value, age) in readings.items()},
+        }
+        r_topic = self.r_topic
+        if qid is not None:
+            answer["id"] = qid
+            r_topic = f"{self.r_topic}/{qid}"
+        self.controller.publish(r_topic, json.dumps(answer), retain=False)
+        return True
@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import json
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Sampler:
+    """Samples every sensor when a trigger is broadcast so readings
+    across many hosts are taken at the same moment.
+
+    The trigger payload is either a plain trigger id or json:
+      {"id": "abc", "at": <unix time>, "prefix": "sensor/w1/"}
+    "at" schedules the sample for a wall-clock instant (hosts should
+    be running NTP) and "prefix" limits which sensors are sampled.
+    Without an id, "at" is used as the id.
+
+    Each reading is published to the sensor topic with "sensor/"
+    replaced by "sample/" as json carrying the trigger id.
+
+    mode is "periodic" (no triggers), "trigger" (only triggers) or
+    "both".
+    """
+    MODES = ("periodic", "trigger", "both")
+
+    def __init__(self, controller, mode="periodic", topic="control/sample"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown sample-mode {mode}")
+        self.controller = controller
+        self.mode = mode
+        self.topic = topic
+        # Triggers may arrive more than once (eg from several brokers)
+        self.seen = collections.deque(maxlen=32)
+        self.tasks = set()
+        if mode != "periodic":
+            controller.subscribe(topic)
+            controller.add_handler(self.handle_message)
+            controller.add_cleanup_callback(self.stop)
+
+    @property
+    def periodic(self):
+        """True if sensors should run their own periodic loops"""
+        return self.mode != "trigger"
+
+    def handle_message(self, topic, payload):
+        if topic != self.topic:
+            return False
+        try:
+            payload = payload.decode("utf-8").strip()
+        except UnicodeDecodeError as e:
+            logger.warning(f"Ignoring trigger {payload}: {e}")
+            return True
+        try:
+            trigger = json.loads(payload)
+        except ValueError:
+            trigger = None
+        if not isinstance(trigger, dict):
+            trigger = {"id": payload}
+
+        trigger_id = str(trigger.get("id", "") or "")
+        at = trigger.get("at", None)
+        if at is not None:
+            try:
+                at = float(at)
+                if not math.isfinite(at):
+                    raise ValueError()
+            except (TypeError, ValueError):
+                logger.warning(f"Ignoring trigger '{trigger_id}' with "
+                               f"bad time '{at}'")
+                return True
+        prefix = trigger.get("prefix", "")
+        if not isinstance(prefix, str):
+            logger.warning(f"Ignoring trigger '{trigger_id}' with "
+                           f"bad prefix '{prefix}'")
+            return True
+        if not trigger_id:
+            if at is None:
+                logger.warning(f"Ignoring trigger with no id: {payload}")
+                return True
+            # Every host sees the same time so it makes a fine id
+            trigger_id = f"{at}"
+
+        if trigger_id in self.seen:
+            logger.debug(f"Ignoring repeated trigger {trigger_id}")
+            return True
+        self.seen.append(trigger_id)
+
+        task = asyncio.create_task(
+            self.sample(trigger_id, at, prefix))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def sample(self, trigger_id, at=None, prefix=""):
+        if at is not None:
+            delay = at - time.time()
+            if delay > 0:
+                logger.debug(f"Trigger {trigger_id} in {delay:.3f}s")
+                await asyncio.sleep(delay)
+            elif delay < -1:
+                logger.warning(f"Trigger {trigger_id} arrived "
+                               f"{-delay:.3f}s late")
+
+        cache = self.controller.cache
+        prefixes = [s.prefix for s in cache.sources.values()
+                    if s.overlaps(prefix)]
+        started = time.time()
+        since = time.monotonic()
+        results = await asyncio.gather(
+            *[cache.read(p, since=since) for p in prefixes],
+            return_exceptions=True)
+
+        for p, readings in zip(prefixes, results):
+            if isinstance(readings, Exception):
+                logger.warning(f"Exception '{readings}' sampling {p} "
+                               f"for trigger {trigger_id}")
+                continue
+            for topic, value in readings.items():
+                if value is None:
+                    continue
+                self.controller.publish(
+                    "sample/" + topic[len("sensor/"):],
+                    json.dumps({"trigger": trigger_id,
+                                "time": started,
+                                "value": value}),
+                    retain=False)
+
+    async def stop(self):
+        for t in list(self.tasks):
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -255,8 +255,10 @@ class TSL2561:
         self.topic = f"sensor/i2c/lux/{controller.host}/{i2c_bus}/{i2c_addr}"
         self.period = period
 
-        self._task = asyncio.create_task(self.run())
-        controller.add_cleanup_callback(self.stop)
+        controller.cache.add_source(self.topic, self.read)
+        if controller.sampler.periodic:
+            self._task = asyncio.create_task(self.run())
+            controller.add_cleanup_callback(self.stop)
 
         self.sensor = TSL2561Sensor(
             i2c_bus=i2c_bus,
@@ -264,13 +266,19 @@ class TSL2561:
             integration=TSL2561Sensor.INTEGRATIONTIME_100MS,
             gain=TSL2561Sensor.GAIN_HIGH)
 
+    async def read(self):
+        lux = await self.sensor.aget_lux()
+        return {self.topic: int(lux)}
+
     async def run(self):
         try:
             while True:
-                lux = await self.sensor.aget_lux()
+                # Share the read with any queries waiting on the sensor
+                readings = await self.controller.cache.read(self.topic)
+                lux = readings[self.topic]
                 logger.debug("TSL2561: {}", lux)
                 self.controller.publish(
-                    self.topic, int(lux))
+                    self.topic, lux)
                 await asyncio.sleep(self.period)
         except asyncio.CancelledError:  # This will be raised politely in await
             logger.debug("TSL2561 exiting cleanly")
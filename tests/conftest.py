@@ -0,0 +1,31 @@
+import pytest
+
+
+class FakeController:
+    """Records what sensors do with the controller instead of talking
+    to MQTT"""
+    host = "testhost"
+
+    def __init__(self):
+        self.subscriptions = []
+        self.handlers = []
+        self.cleanup_callbacks = []
+        self.published = []
+        self.history = None
+
+    def subscribe(self, topic):
+        self.subscriptions.append(topic)
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def add_cleanup_callback(self, handler):
+        self.cleanup_callbacks.append(handler)
+
+    def publish(self, topic, payload, retain=True):
+        self.published.append((topic, payload))
+
+
+@pytest.fixture
+def controller():
+    return FakeController()
@@ -0,0 +1,182 @@
+import asyncio
+
+import pytest
+
+from sensor2mqtt.Brokers import Broker
+from sensor2mqtt.MQController import MQController
+
+
+class StandInClient:
+    """Stands in for a gmqtt client talking to a local broker"""
+    up = {}  # host: True if that broker accepts connections
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.is_connected = False
+        self.broken = False  # Connection lost but not yet noticed
+        self.published = []
+        self.subscribed = []
+
+    def set_auth_credentials(self, username, password):
+        pass
+
+    async def connect(self, host, port=1883, version=None):
+        if not self.up.get(host, False):
+            raise ConnectionRefusedError(host)
+        self.reconnect()
+
+    def reconnect(self):
+        self.is_connected = True
+        self.on_connect(self, 0, 0, None)
+
+    def drop(self):
+        self.is_connected = False
+        self.on_disconnect(self, None)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if self.broken:
+            raise ConnectionResetError()
+        self.published.append((topic, payload))
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+
+    async def disconnect(self):
+        self.is_connected = False
+
+
+@pytest.fixture
+async def make_controller(monkeypatch):
+    monkeypatch.setattr(Broker, "client_class", StandInClient)
+    controllers = []
+
+    async def make(mode="failover", up=("a", "b"), **broker):
+        monkeypatch.setattr(StandInClient, "up", {h: True for h in up})
+        c = MQController({
+            "mqtt-mode": mode,
+            "mqtt-brokers": [dict(host="a", **broker),
+                             dict(host="b", **broker)],
+        })
+        controllers.append(c)
+        await c.connect()
+        await asyncio.sleep(0)  # Let every broker try to connect
+        return c
+
+    yield make
+    for c in controllers:
+        await asyncio.gather(*[b.stop() for b in c.brokers])
+
+
+def clients(controller):
+    return [b.mqtt for b in controller.brokers]
+
+
+async def test_failover_uses_first_healthy_broker(make_controller):
+    c = await make_controller("failover")
+    a, b = clients(c)
+    c.publish("sensor/x", 1)
+    await asyncio.sleep(0)
+    assert a.published == [("sensor/x", 1)]
+    assert b.published == []
+
+
+async def test_failover_uses_standby_when_primary_down(make_controller):
+    c = await make_controller("failover", up=("b",))
+    a, b = clients(c)
+    c.publish("sensor/x", 1)
+    await asyncio.sleep(0)
+    assert a.published == []
+    assert b.published == [("sensor/x", 1)]
+
+
+async def test_failover_moves_queued_messages(make_controller):
+    c = await make_controller("failover")
+    a, b = clients(c)
+    # Queued on a when publishing fails, before a notices it's down
+    a.broken = True
+    c.publish("sensor/a", 1)
+    assert a.published == []
+    a.broken = False
+    a.drop()
+    c.publish("sensor/b", 2)
+    await asyncio.sleep(0)
+    assert a.published == []
+    assert b.published == [("sensor/a", 1), ("sensor/b", 2)]
+    assert not c.brokers[0].pending
+
+    # And back to the primary when it returns
+    a.reconnect()
+    c.publish("sensor/c", 3)
+    await asyncio.sleep(0)
+    assert a.published == [("sensor/c", 3)]
+
+
+async def test_failover_sends_messages_queued_while_all_down(
+        make_controller):
+    c = await make_controller("failover")
+    a, b = clients(c)
+    a.drop()
+    b.drop()
+    c.publish("sensor/x", 1)
+    await asyncio.sleep(0)
+    b.reconnect()
+    await asyncio.sleep(0)
+    assert b.published == [("sensor/x", 1)]
+    assert not c.brokers[0].pending
+
+
+async def test_fanout_publishes_to_every_broker(make_controller):
+    c = await make_controller("fanout")
+    a, b = clients(c)
+    c.publish("sensor/x", 1)
+    await asyncio.sleep(0)
+    assert a.published == [("sensor/x", 1)]
+    assert b.published == [("sensor/x", 1)]
+
+
+async def test_queue_drops_oldest_when_full(make_controller):
+    c = await make_controller("fanout", **{"max-pending": 2})
+    a, b = clients(c)
+    b.drop()
+    for n in range(3):
+        c.publish("sensor/x", n)
+        await asyncio.sleep(0)
+    # A slow broker doesn't hold up the healthy one
+    assert a.published == [("sensor/x", n) for n in range(3)]
+    assert list(c.brokers[1].pending) == [("sensor/x", 1, True),
+                                          ("sensor/x", 2, True)]
+    assert c.brokers[1].dropped == 1
+
+    b.reconnect()
+    await asyncio.sleep(0)
+    assert b.published == [("sensor/x", 1), ("sensor/x", 2)]
+
+
+async def test_burst_on_healthy_broker_not_dropped(make_controller):
+    c = await make_controller("fanout", **{"max-pending": 10})
+    a, b = clients(c)
+    for n in range(25):
+        c.publish("sensor/x", n)
+    assert a.published == [("sensor/x", n) for n in range(25)]
+    assert b.published == a.published
+    assert c.brokers[0].dropped == c.brokers[1].dropped == 0
+
+
+@pytest.mark.parametrize("mode, expected", [
+    ("failover", ["a"]),
+    ("fanout", ["a", "b"]),
+])
+async def test_messages_from_standby_ignored(make_controller, mode,
+                                             expected):
+    c = await make_controller(mode)
+    received = []
+
+    def handler(topic, payload):
+        received.append(payload.decode())
+        return True
+    c.add_handler(handler)
+
+    for client, name in zip(clients(c), ("a", "b")):
+        await client.on_message(client, "control/x", name.encode(),
+                                0, None)
+    assert received == expected
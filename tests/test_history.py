@@ -0,0 +1,207 @@
+import asyncio
+import json
+import struct
+import threading
+import time
+import zlib
+
+import pytest
+
+from sensor2mqtt.History import RECORD, History, Ring, Tier
+
+
+def make_ring(tmp_path, capacity):
+    return Ring(str(tmp_path / "ring.dat"), capacity * RECORD.size)
+
+
+def times(ring, *args):
+    return [r[0] for r in ring.records(*args)]
+
+
+def test_new_ring_is_empty(tmp_path):
+    ring = make_ring(tmp_path, 10)
+    assert (ring.head, ring.lap) == (0, 1)
+    assert times(ring) == []
+
+
+@pytest.mark.parametrize("n", [3, 10, 13, 20, 27])
+def test_reopened_ring_continues_where_it_left_off(tmp_path, n):
+    ring = make_ring(tmp_path, 10)
+    for t in range(n):
+        ring.append(t, 0, t)
+    head, lap = ring.head, ring.lap
+    ring.close()
+
+    ring = make_ring(tmp_path, 10)
+    assert (ring.head, ring.lap) == (head, lap)
+    # Oldest first across the wrap
+    assert times(ring) == list(range(max(0, n - 10), n))
+    ring.append(n, 0, n)
+    assert times(ring)[-1] == n
+
+
+def test_reopened_exactly_full_ring(tmp_path):
+    ring = make_ring(tmp_path, 10)
+    for t in range(10):
+        ring.append(t, 0, t)
+    ring.close()
+
+    ring = make_ring(tmp_path, 10)
+    assert (ring.head, ring.lap) == (0, 2)
+    assert times(ring) == list(range(10))
+
+
+@pytest.mark.parametrize("n", [7, 10, 16])
+def test_records_in_time_range(tmp_path, n):
+    ring = make_ring(tmp_path, 10)
+    for t in range(n):
+        ring.append(t, 0, t)
+    held = list(range(max(0, n - 10), n))
+    for start in range(-1, n + 1):
+        for end in range(start, n + 2):
+            assert times(ring, start, end) == [
+                t for t in held if start <= t <= end]
+
+
+def test_tier_means(tmp_path):
+    tier = Tier("minute", 60, 3600, make_ring(tmp_path, 10))
+    for t, v in ((60, 1), (70, 3), (119, 5), (120, 10), (185, 7)):
+        tier.add(t, 0, v)
+    # The current bucket of each series is only held in memory
+    assert [(r[0], r[3]) for r in tier.ring.records()] == [
+        (60, 3), (120, 10)]
+    # A time from before the current bucket goes into it
+    tier.add(125, 1, 4)
+    tier.flush(0)
+    tier.flush(1)
+    assert [(r[0], r[1], r[3]) for r in tier.ring.records()][2:] == [
+        (180, 0, 7), (180, 1, 4)]
+
+
+def test_tier_flushes_every_ended_bucket(tmp_path):
+    tier = Tier("minute", 60, 3600, make_ring(tmp_path, 100))
+    tier.add(0, 0, 1)
+    for t in range(60, 1860, 60):
+        tier.add(t, 1, t)
+    tier.add(1860, 0, 2)
+    # Series 0's first bucket was written when series 1 moved on
+    assert times(tier.ring) == list(range(0, 1860, 60))
+    assert [r[1] for r in tier.ring.records(0, 59)] == [0]
+
+
+def test_records_from_position(tmp_path):
+    ring = make_ring(tmp_path, 10)
+    for t in range(5):
+        ring.append(t, 0, t)
+    position = ring.position()
+    for t in range(5, 8):
+        ring.append(t, 0, t)
+    # Records appended since the position are not seen
+    assert times(ring, None, None, position) == [0, 1, 2, 3, 4]
+    assert times(ring, 3, None, position) == [3, 4]
+
+
+@pytest.fixture
+def history(controller, tmp_path):
+    return History(controller, str(tmp_path), budget=0.01)
+
+
+def test_budget_too_small(controller, tmp_path):
+    with pytest.raises(ValueError, match="too small"):
+        History(controller, str(tmp_path), budget=0.00001)
+
+
+async def test_range_query(history):
+    for n in range(5):
+        history.append("sensor/a", n)
+        history.append("sensor/b", 100 + n)
+    history.append("sensor/a", "Not a number")
+
+    await history.handle_message(history.q_topic, json.dumps({
+        "id": "q1", "topic": "sensor/a",
+        "start": time.time() - 60}).encode())
+    (block_topic, block), (topic, summary) = history.controller.published
+    assert block_topic == f"{history.r_topic}/q1/0"
+    assert topic == f"{history.r_topic}/q1"
+    assert json.loads(summary) == {"topic": "sensor/a", "tier": "raw",
+                                   "records": 5, "blocks": 1}
+    values = [v for (_t, v) in struct.iter_unpack("<df",
+                                                  zlib.decompress(block))]
+    assert values == [0, 1, 2, 3, 4]
+
+
+async def test_history_survives_restart(controller, tmp_path):
+    history = History(controller, str(tmp_path), budget=0.01)
+    history.append("sensor/a", 1.5)
+    await history.close()
+
+    history = History(controller, str(tmp_path), budget=0.01)
+    assert history.series == {"sensor/a": 0}
+    assert [r[3] for r in history.tiers["raw"].ring.records()] == [1.5]
+    # The partial means were written out on close
+    assert [r[3] for r in history.tiers["hour"].ring.records()] == [1.5]
+
+
+async def test_close_waits_for_scans(history, monkeypatch):
+    history.append("sensor/a", 1)
+    scanning = threading.Event()
+    scan = history.scan
+
+    def slow_scan(*args):
+        scanning.set()
+        time.sleep(0.1)
+        return scan(*args)
+    monkeypatch.setattr(history, "scan", slow_scan)
+
+    query = asyncio.create_task(history.handle_message(
+        history.q_topic, json.dumps({"id": "q1", "topic": "sensor/a",
+                                     "tier": "raw"}).encode()))
+    while not scanning.is_set():
+        await asyncio.sleep(0.01)
+    await history.close()
+    await query
+    assert json.loads(history.controller.published[-1][1])["records"] == 1
+
+    # And new queries are refused
+    assert await history.handle_message(history.q_topic, b"{}")
+    assert len(history.controller.published) == 2
+
+
+async def test_series_at_different_rates(history, monkeypatch):
+    now = [1000000.0]
+
+    class Clock:
+        @staticmethod
+        def time():
+            return now[0]
+    monkeypatch.setattr("sensor2mqtt.History.time", Clock)
+
+    history.append("sensor/a", 1)
+    for _ in range(30):
+        now[0] += 60
+        history.append("sensor/b", 2)
+    history.append("sensor/a", 3)
+
+    await history.handle_message(history.q_topic, json.dumps({
+        "id": "q1", "topic": "sensor/a", "tier": "minute",
+        "start": 1000000 - 60, "end": 1000000 + 60}).encode())
+    (_, block), (_, summary) = history.controller.published
+    assert json.loads(summary)["records"] == 1
+    assert list(struct.iter_unpack("<df", zlib.decompress(block))) == [
+        (1000000 - 1000000 % 60, 1)]
+
+
+@pytest.mark.parametrize("query", [
+    [1],
+    "q1",
+    {"id": "q1", "topic": "sensor/a", "start": None},
+    {"id": "q1", "topic": "sensor/a", "end": [1]},
+    {"id": "q/1", "topic": "sensor/a"},
+    {"id": "q#", "topic": "sensor/a"},
+    {"id": "", "topic": "sensor/a"},
+])
+async def test_bad_query_rejected(history, query):
+    history.append("sensor/a", 1)
+    assert await history.handle_message(history.q_topic,
+                                        json.dumps(query).encode())
+    assert history.controller.published == []
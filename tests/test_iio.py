@@ -0,0 +1,147 @@
+import logging
+import math
+import struct
+
+import numpy as np
+import pytest
+
+from sensor2mqtt.IIO import IIO, IIOChannel
+
+# Raw sample values for each scan element, two blocks of four scans
+COUNT = [1, 2, 3, 4, 5, 6, 7, 8]
+VOLTAGE0 = [-2048, -1, 0, 2047, -100, 100, 5, -5]  # s12/16>>4
+VOLTAGE1 = [0, 1, 512, 1023, 10, 20, 30, 40]  # be u10/16
+
+# voltage0 gets the shared scale; voltage1 has its own scale and offset
+V0 = [v * 0.5 for v in VOLTAGE0]
+V1 = [(v + 1) * 2.0 for v in VOLTAGE1]
+
+SCAN_ELEMENTS = {
+    # name: (index, type)
+    "count": (0, "le:u8/8>>0"),
+    "voltage0": (1, "le:s12/16>>4"),
+    "voltage1": (2, "be:u10/16>>0"),
+    "timestamp": (3, "le:s64/64>>0"),
+}
+
+
+@pytest.fixture
+def recording(tmp_path):
+    """A copy of a device's sysfs directory and a buffer captured from
+    it"""
+    device = tmp_path / "iio:device0"
+    scan_dir = device / "scan_elements"
+    scan_dir.mkdir(parents=True)
+    for name, (index, type_desc) in SCAN_ELEMENTS.items():
+        (scan_dir / f"in_{name}_en").write_text("1\n")
+        (scan_dir / f"in_{name}_index").write_text(f"{index}\n")
+        (scan_dir / f"in_{name}_type").write_text(f"{type_desc}\n")
+    (device / "in_voltage_scale").write_text("0.5\n")
+    (device / "in_voltage1_scale").write_text("2\n")
+    (device / "in_voltage1_offset").write_text("1\n")
+
+    buffer_file = tmp_path / "capture.bin"
+    with open(buffer_file, "wb") as f:
+        for n, (c, v0, v1) in enumerate(zip(COUNT, VOLTAGE0, VOLTAGE1)):
+            f.write(struct.pack("<B", c))
+            f.write(b"\xaa")  # padding to align voltage0
+            # Low bits below the shift are noise
+            f.write(struct.pack("<H", ((v0 & 0xFFF) << 4) | 0xF))
+            # As are bits above the 10 used
+            f.write(struct.pack(">H", v1 | 0xFC00))
+            f.write(b"\xbb" * 2)  # padding to align the timestamp
+            f.write(struct.pack("<q", 1000 * n))
+    return {"sysfs": str(tmp_path), "buffer_file": str(buffer_file)}
+
+
+async def replay(controller, recording, **kwargs):
+    iio = IIO(controller, decimate=4, **recording, **kwargs)
+    await iio._task
+    await iio.stop()
+    return iio
+
+
+def published(controller, prefix="sensor/"):
+    values = {}
+    for topic, payload in controller.published:
+        if topic.startswith(prefix):
+            values.setdefault(topic.rsplit("/", 1)[1], []).append(payload)
+    return values
+
+
+@pytest.mark.parametrize("type_desc, raw, value", [
+    ("le:s12/16>>4", 0xFFF0, -1),
+    ("le:s12/16>>4", 0x7FF0, 2047),
+    ("le:s12/16>>4", 0x800F, -2048),
+    ("le:u12/16>>4", 0xFFF0, 4095),
+    ("be:s16/16>>0", 0x8000, -32768),
+    ("le:u10/16>>0", 0xFFFF, 1023),
+    ("le:s24/32>>8", 0xFFFFFF00, -1),
+])
+def test_channel_decode(type_desc, raw, value):
+    c = IIOChannel("x", 0, type_desc)
+    scans = np.array([raw], dtype=c.dtype.replace("i", "u"))
+    scans = scans.astype(c.dtype).view([("x", c.dtype)])
+    assert c.decode(scans)[0] == value
+
+
+def test_bad_type():
+    with pytest.raises(ValueError):
+        IIOChannel("x", 0, "le:s12")
+
+
+async def test_layout(controller, recording):
+    iio = IIO(controller, **recording)
+    await iio.stop()
+    assert [c.name for c in iio.channels] == list(SCAN_ELEMENTS)
+    assert iio.offsets() == [0, 2, 4, 8]
+    assert iio.scan_dtype.itemsize == 16
+
+
+async def test_mean(controller, recording):
+    await replay(controller, recording)
+    values = published(controller)
+    # The timestamp is not published
+    assert sorted(values) == ["count", "voltage0", "voltage1"]
+    assert values["count"] == [2.5, 6.5]
+    assert values["voltage0"] == pytest.approx(
+        [np.mean(V0[:4]), np.mean(V0[4:])])
+    assert values["voltage1"] == pytest.approx(
+        [np.mean(V1[:4]), np.mean(V1[4:])])
+
+
+async def test_rms(controller, recording):
+    await replay(controller, recording, reduce="rms")
+    values = published(controller)
+    assert values["voltage0"] == pytest.approx(
+        [math.sqrt(np.mean(np.square(V0[:4]))),
+         math.sqrt(np.mean(np.square(V0[4:])))])
+
+
+async def test_block(controller, recording):
+    await replay(controller, recording, reduce="block",
+                 channels=["voltage0", "voltage1"])
+    values = published(controller, "block/")
+    assert sorted(values) == ["voltage0", "voltage1"]
+    assert [np.frombuffer(b, "<f4").tolist() for b in values["voltage0"]] \
+        == [V0[:4], V0[4:]]
+    assert [np.frombuffer(b, "<f4").tolist() for b in values["voltage1"]] \
+        == [V1[:4], V1[4:]]
+
+
+async def test_unknown_channel(controller, recording):
+    with pytest.raises(ValueError):
+        IIO(controller, channels=["voltage9"], **recording)
+
+
+async def test_read_error_stops_cleanly(controller, recording, caplog):
+    iio = IIO(controller, **recording)
+
+    async def removed():
+        raise OSError(19, "No such device")
+    iio.read_block = removed
+    await iio._task
+    # stop() must not raise or the other cleanup callbacks don't run
+    await iio.stop()
+    assert any(r.levelno == logging.WARNING and "No such device" in
+               r.getMessage() for r in caplog.records)
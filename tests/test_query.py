@@ -0,0 +1,110 @@
+import asyncio
+import json
+
+import pytest
+
+from sensor2mqtt.Query import ReadingCache
+
+
+class CountingSource:
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.reads = 0
+        self.finished = 0
+
+    async def read(self):
+        self.reads += 1
+        await asyncio.sleep(self.delay)
+        self.finished += 1
+        return {"sensor/x/1": self.reads, "sensor/x/2": None}
+
+
+@pytest.fixture
+def cache(controller):
+    return ReadingCache(controller, ttl=60)
+
+
+async def query(cache, prefix=""):
+    await cache.handle_message(cache.q_topic, prefix.encode())
+    topic, payload = cache.controller.published[-1]
+    assert topic == cache.r_topic
+    return json.loads(payload)
+
+
+async def test_concurrent_queries_share_one_read(cache):
+    source = CountingSource()
+    cache.add_source("sensor/x/", source.read)
+    answers = await asyncio.gather(*[query(cache) for _ in range(10)])
+    assert source.reads == 1
+    for answer in answers:
+        # Failed readings (None) are not cached
+        assert list(answer["readings"]) == ["sensor/x/1"]
+        assert answer["readings"]["sensor/x/1"]["value"] == 1
+
+
+async def test_fresh_source_not_reread_within_ttl(cache):
+    source = CountingSource()
+    cache.add_source("sensor/x/", source.read)
+    await cache.read("sensor/x/")
+    await query(cache, "sensor/x")
+    assert source.reads == 1
+
+    cache.ttl = 0
+    answer = await query(cache, "sensor/x")
+    assert source.reads == 2
+    assert answer["readings"]["sensor/x/1"]["value"] == 2
+
+
+async def test_query_only_reads_matching_sources(cache):
+    x = CountingSource()
+    y = CountingSource()
+    cache.add_source("sensor/x/", x.read)
+    cache.add_source("sensor/y/", y.read)
+    await query(cache, "sensor/y/")
+    assert (x.reads, y.reads) == (0, 1)
+
+
+async def test_published_values_served_from_cache(cache):
+    cache.update("sensor/pir/testhost/17", True)
+    answer = await query(cache, "sensor/pir")
+    assert answer["readings"]["sensor/pir/testhost/17"]["value"] is True
+
+
+async def test_stop_cancels_running_read(cache):
+    source = CountingSource(delay=10)
+    cache.add_source("sensor/x/", source.read)
+    reader = asyncio.create_task(cache.read("sensor/x/"))
+    await asyncio.sleep(0)
+    # A sensor's run loop being cancelled leaves the shielded read
+    reader.cancel()
+    await asyncio.gather(reader, return_exceptions=True)
+    assert cache.sources["sensor/x/"].task is not None
+
+    await cache.stop()
+    assert source.finished == 0
+    assert cache.sources["sensor/x/"].task is None
+
+
+async def test_query_with_id(cache):
+    cache.update("sensor/x/1", 1)
+    cache.update("sensor/y/1", 2)
+    await cache.handle_message(cache.q_topic, json.dumps(
+        {"id": "dash1", "prefix": "sensor/y"}).encode())
+    topic, payload = cache.controller.published[-1]
+    assert topic == f"{cache.r_topic}/dash1"
+    answer = json.loads(payload)
+    assert answer["id"] == "dash1"
+    assert list(answer["readings"]) == ["sensor/y/1"]
+
+
+@pytest.mark.parametrize("payload", [
+    b"\xff\xfe",
+    b"{not json",
+    json.dumps({"id": "a/b"}).encode(),
+    json.dumps({"id": "#"}).encode(),
+    json.dumps({"id": ""}).encode(),
+    json.dumps({"id": "q", "prefix": 5}).encode(),
+])
+async def test_bad_query_ignored(cache, payload):
+    assert await cache.handle_message(cache.q_topic, payload)
+    assert cache.controller.published == []
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from sensor2mqtt.Query import ReadingCache
+from sensor2mqtt.Sampling import Sampler
+
+
+@pytest.fixture
+def sampler(controller):
+    controller.cache = ReadingCache(controller)
+    reads = []
+
+    async def read():
+        reads.append(time.time())
+        return {"sensor/x/1": 21.5}
+    controller.cache.add_source("sensor/x/", read)
+    sampler = Sampler(controller, mode="both")
+    sampler.reads = reads
+    return sampler
+
+
+async def trigger(sampler, payload):
+    if not isinstance(payload, str):
+        payload = json.dumps(payload)
+    assert sampler.handle_message("control/sample", payload.encode())
+    await asyncio.gather(*sampler.tasks)
+
+
+def samples(sampler):
+    return [json.loads(p) for (t, p) in sampler.controller.published
+            if t.startswith("sample/")]
+
+
+async def test_sample_carries_trigger_id(sampler):
+    await trigger(sampler, "t1")
+    (sample,) = samples(sampler)
+    assert sample["trigger"] == "t1"
+    assert sample["value"] == 21.5
+    assert sampler.controller.published[0][0] == "sample/x/1"
+
+
+async def test_repeated_trigger_ignored(sampler):
+    await trigger(sampler, {"id": "t1"})
+    await trigger(sampler, {"id": "t1"})
+    assert len(sampler.reads) == 1
+
+
+async def test_trigger_scheduled_at(sampler):
+    at = time.time() + 0.05
+    await trigger(sampler, {"id": "t1", "at": at})
+    assert sampler.reads[0] >= at
+
+
+async def test_trigger_without_id_uses_at(sampler):
+    await trigger(sampler, {"at": 0})
+    await trigger(sampler, {"at": 1})
+    assert [s["trigger"] for s in samples(sampler)] == ["0.0", "1.0"]
+
+
+async def test_trigger_without_id_or_at_rejected(sampler):
+    await trigger(sampler, "")
+    await trigger(sampler, {"prefix": "sensor/x"})
+    assert sampler.reads == []
+    assert not sampler.seen
+
+
+async def test_bad_at_rejected(sampler):
+    await trigger(sampler, {"id": "t1", "at": "soon"})
+    assert sampler.reads == []
+    # The id can still be used once the time is fixed
+    await trigger(sampler, {"id": "t1", "at": 0})
+    assert len(sampler.reads) == 1
+
+
+@pytest.mark.parametrize("at", ["inf", "-inf", "nan", "Infinity"])
+async def test_non_finite_at_rejected(sampler, at):
+    await trigger(sampler, {"id": "t1", "at": at})
+    assert sampler.reads == []
+    assert not sampler.tasks
+    assert not sampler.seen
+
+
+@pytest.mark.parametrize("prefix", [5, None, ["sensor/x"]])
+async def test_bad_prefix_rejected(sampler, prefix):
+    await trigger(sampler, {"id": "t1", "prefix": prefix})
+    assert sampler.reads == []
+    assert not sampler.tasks
+    assert not sampler.seen
+
+
+async def test_undecodable_trigger_rejected(sampler):
+    assert sampler.handle_message("control/sample", b"\xff\xfe")
+    assert not sampler.tasks